@@ -0,0 +1,92 @@
+import threading
+import time
+
+class NegativeCache:
+    """
+    Remembers words that keep failing to produce a joke, so that we don't
+    spend more model calls on the same dead end.
+
+    Each entry is keyed by the kind of attempt (e.g. 'phrase', 'component',
+    'change' or 'topic') and the word that was tried. Joke generation is
+    random, so a single failure doesn't mean much. A word is only treated as a
+    known failure once it has failed a few times within the TTL. The total
+    failure counts are kept after that so that the worst offenders can be
+    pruned from the word lists offline.
+    """
+
+    def __init__(self, ttl=3600, threshold=3, max_entries=10000):
+        """
+        Arguments:
+        ttl         -- Seconds a failure is remembered before the word is retried.
+        threshold   -- Failures within the TTL before a word is skipped.
+        max_entries -- Most words tracked. Once exceeded, expired entries are
+                       dropped first, then the least failed.
+        """
+        self._ttl = ttl
+        self._threshold = threshold
+        self._max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def record_failure(self, kind, word):
+        """Counts a failure of the word for the given kind of attempt."""
+        now = time.monotonic()
+        with self._lock:
+            (count, recent, expires) = self._entries.get((kind, word), (0, 0, now))
+            if expires <= now:
+                recent = 0
+            self._entries[(kind, word)] = (count + 1, recent + 1, now + self._ttl)
+
+            if len(self._entries) > self._max_entries:
+                self._evict(now)
+
+    def is_known_failure(self, kind, word):
+        """True if the word has failed enough times recently to be skipped."""
+        with self._lock:
+            entry = self._entries.get((kind, word))
+        return entry is not None \
+            and entry[1] >= self._threshold \
+            and entry[2] > time.monotonic()
+
+    def entries(self):
+        """
+        Lists every tracked failure, most frequent first. Includes expired
+        entries, as they are still useful when pruning the word lists.
+
+        Returns a list of dicts with the kind, word, count and whether the
+        word is currently being skipped.
+        """
+        now = time.monotonic()
+        with self._lock:
+            snapshot = list(self._entries.items())
+
+        snapshot.sort(key=lambda item: item[1][0], reverse=True)
+        return [{"kind": kind, "word": word, "count": count,
+                 "active": recent >= self._threshold and expires > now}
+                for ((kind, word), (count, recent, expires)) in snapshot]
+
+    def add_counts(self, kind, word, count):
+        """
+        Adds to the total failure count for a word without making it a known
+        failure. Used to carry counts over from a previous run.
+        """
+        with self._lock:
+            (total, recent, expires) = self._entries.get((kind, word), (0, 0, 0))
+            self._entries[(kind, word)] = (total + count, recent, expires)
+
+            if len(self._entries) > self._max_entries:
+                self._evict(time.monotonic())
+
+    def _evict(self, now):
+        """
+        Shrinks the cache to 90% of its limit, so that eviction doesn't run on
+        every new failure. Keeps words being skipped first, then the most
+        failed, then the most recently failed.
+        """
+        keep = int(self._max_entries * 0.9)
+        ranked = sorted(self._entries.items(),
+                        key=lambda item: (item[1][1] >= self._threshold and item[1][2] > now,
+                                          item[1][0],
+                                          item[1][2]),
+                        reverse=True)
+        self._entries = dict(ranked[:keep])
@@ -1,36 +1,82 @@
+import atexit
 import os
-import re
 import logging
 
 import openai
 
 from errors import *
+from parsing import ParseStats, parse_word_list, parse_joke, STRUCTURED, FAILED
 
 # ChatCompletions
 _GPT_3_5 = "gpt-3.5-turbo" 
 
-# Patterns
-_SOUND_ALIKE_PATTERN = re.compile("(?:\w+, )+\w+")
-_SETUP_PATTERN = re.compile("(?<=SETUP:)(.*)\n?(?=PUNCHLINE:)")
-_PUNCHLINE_PATTERN = re.compile("(?<=PUNCHLINE:)(.*)")
+# Functions the model is asked to call, so responses come back as JSON
+_WORD_LIST_FUNCTION = {
+    "name": "list_words",
+    "description": "Record a list of words.",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "words": {"type": "array", "items": {"type": "string"}}
+        },
+        "required": ["words"]
+    }
+}
+_JOKE_FUNCTION = {
+    "name": "tell_joke",
+    "description": "Record a joke.",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "setup": {"type": "string"},
+            "punchline": {"type": "string"}
+        },
+        "required": ["setup", "punchline"]
+    }
+}
 
 class Models:    
     def __init__(self):
         openai.api_key = os.getenv("OPENAI_API_KEY")
-
-    def _completion(self, system, user, model=_GPT_3_5, temperature=1.0):
+        self._parse_stats = ParseStats()
+        atexit.register(self.log_parse_stats)
+
+    def get_parse_stats(self):
+        """Returns how often each prompt's responses could be parsed."""
+        return self._parse_stats.rates()
+
+    def log_parse_stats(self):
+        """Logs the parse rates for every prompt. Called automatically on shutdown."""
+        logging.info(f"Model response parse rates: {self.get_parse_stats()}")
+
+    def _completion(self, system, user, model=_GPT_3_5, temperature=1.0, function=None):
+        """
+        Sends the prompt to the model. If a function is supplied the model is
+        asked to call it, and the JSON arguments are returned instead of the
+        message content.
+        """
         messages = [{"role": "system", "content": system}]
         if user is not list: user = [user]
         for message in user:
             messages.append({"role": "user", "content": message})
 
+        options = {}
+        if function:
+            options["functions"] = [function]
+            options["function_call"] = {"name": function["name"]}
+
         try:
             response = openai.ChatCompletion.create(            
                 model=model,            
                 temperature=temperature,
-                messages=messages   
+                messages=messages,
+                **options
             )
-            return response.choices[0].message.content
+            message = response.choices[0].message
+            function_call = message.get("function_call")
+            if function_call:
+                return function_call.get("arguments") or ""
+            return message.content or ""
         except openai.error.APIError as e:
             logging.error("Open AI was unable to process a request")
             raise RetriableOpenAIError(e)
@@ -60,67 +106,55 @@ class Models:
     def get_words_that_sound_like(self, word):
         _prompt = """
 You are a poet's assistant. You generate options for words that either rhyme with or sound like other words.
-Return a comma separated list of words. Do not say anything other than the list.
+Record the list of words with the list_words function. Do not say anything else.
 
 Examples: 
-'wave' -> [knave, rave, waive, gave, save, wove]
-'head' -> [red, led, sled, spread, bred, dread]"""        
+'wave' -> {"words": ["knave", "rave", "waive", "gave", "save", "wove"]}
+'head' -> {"words": ["red", "led", "sled", "spread", "bred", "dread"]}"""        
 
         content = self._completion(
             system=_prompt,
-            user=f"'{word}'"
+            user=f"'{word}'",
+            function=_WORD_LIST_FUNCTION
         )
-        matches = _SOUND_ALIKE_PATTERN.findall(content)
-
-        if len(matches) == 1:
-            return matches[0].split(", ")
-        else:
-            raise ModelResponseFormatError("SoundsLike", content)
+        return self._parse_word_list("SoundsLike", content)
 
     def get_words_that_sound_like_component(self, component, context):
         _prompt = """
 You are a poet's assistant. You generate options for words that either rhyme with or sound like other words.
 Users will supply a candidate word, and a larger word or phrase containing that word. 
 This should be used when the word could be pronounced in different ways.  
-Return a comma separated list of words. Do not say anything other than the list.
+Record the list of words with the list_words function. Do not say anything else.
 
 Examples: 
-'wave' from 'microwave' -> [knave, rave, waive, gave, save, wove]
-'read' from 'bread' -> [red, led, sled, spread, bred, dread]
-'read' from 'reading' -> [reed, feed, freed, reek, reap, lead, seed]"""        
+'wave' from 'microwave' -> {"words": ["knave", "rave", "waive", "gave", "save", "wove"]}
+'read' from 'bread' -> {"words": ["red", "led", "sled", "spread", "bred", "dread"]}
+'read' from 'reading' -> {"words": ["reed", "feed", "freed", "reek", "reap", "lead", "seed"]}"""        
 
         content = self._completion(
             system=_prompt,
-            user=f"'{component}' from '{context}'"
+            user=f"'{component}' from '{context}'",
+            function=_WORD_LIST_FUNCTION
         )
-        matches = _SOUND_ALIKE_PATTERN.findall(content)
-
-        if len(matches) == 1:
-            return matches[0].split(", ")
-        else:
-            raise ModelResponseFormatError("SoundsLikeComponent", content)
+        return self._parse_word_list("SoundsLikeComponent", content)
 
     def get_words_with_similar_meanings(self, word):
         _prompt = """
 You are a poet's assistant. You generate words we could write jokes about. 
 Users will supply a topic, and you need to supply a list of related words.
 Include a mix of short words and long words.
-Return a comma separated list of words. Do not say anything other than the list.
+Record the list of words with the list_words function. Do not say anything else.
 
 Examples: 
-'wave' -> [ocean, surf, tide, beach, shore, water, undertow, crest, seashell]
-'head' -> [mind, brain, thought, intellect, cognition, skull, face, forehead]"""        
+'wave' -> {"words": ["ocean", "surf", "tide", "beach", "shore", "water", "undertow", "crest", "seashell"]}
+'head' -> {"words": ["mind", "brain", "thought", "intellect", "cognition", "skull", "face", "forehead"]}"""        
 
         content = self._completion(
             system=_prompt,
-            user=f"'{word}'"
+            user=f"'{word}'",
+            function=_WORD_LIST_FUNCTION
         )
-        matches = _SOUND_ALIKE_PATTERN.findall(content)
-
-        if len(matches) == 1:
-            return matches[0].split(", ")
-        else:
-            raise ModelResponseFormatError("SoundsLike", content)
+        return self._parse_word_list("SimilarMeanings", content)
             
     def joke(self, punchline, original, change):
         _prompt = """
@@ -131,27 +165,42 @@ P: The punchline word
 O: The word it is based on
 C: The part that was substituted in
 
-Write a joke with a setup and a punchline.
+Write a joke with a setup and a punchline, and record it with the tell_joke function.
 
 The setup should reference O and C. The punchline should contain P.
 
 E.g.
 P: fight-mare, O: nightmare, C: fight ->
-SETUP:What do you call a cross between a bad dream and a battle?
-PUNCHLINE:A fightmare!
+{"setup": "What do you call a cross between a bad dream and a battle?", "punchline": "A fightmare!"}
 
 P: pup-cake, O: cupcake, C: pup ->
-SETUP:What dog is made in a bakery?
-PUNCHLINE:A pup-cake!"""        
+{"setup": "What dog is made in a bakery?", "punchline": "A pup-cake!"}"""        
 
         content = self._completion(
             system=_prompt,
-            user=f"P:'{punchline}', O:'{original}', C:'{change}'"
+            user=f"P:'{punchline}', O:'{original}', C:'{change}'",
+            function=_JOKE_FUNCTION
         )
-        setup_matches = _SETUP_PATTERN.findall(content)
-        punchline_matches = _PUNCHLINE_PATTERN.findall(content)
+        (setup, punchline, outcome) = parse_joke(content)
+        self._record_parse("Joke", outcome)
+
+        if outcome == FAILED:
+            raise ModelResponseFormatError("Joke", content)
+        return (setup, punchline)
+
+    def _parse_word_list(self, prompt, content):
+        """Parses a list of words, salvaging it if it isn't JSON."""
+        (words, outcome) = parse_word_list(content)
+        self._record_parse(prompt, outcome)
+
+        if outcome == FAILED:
+            raise ModelResponseFormatError(prompt, content)
+        return words
+
+    def _record_parse(self, prompt, outcome):
+        """Counts the parse outcome, logging the prompt's rates when it wasn't structured."""
+        self._parse_stats.record(prompt, outcome)
 
-        if(len(setup_matches) == 1 and len(punchline_matches) == 1):
-            return (setup_matches[0], punchline_matches[0])
-        else:
-            raise ModelResponseFormatError("Joke", content)
\ No newline at end of file
+        if outcome != STRUCTURED:
+            rates = self._parse_stats.rates()[prompt]
+            logging.info(f"{prompt} response was {outcome}. Parse rates: {rates}")
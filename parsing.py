@@ -0,0 +1,129 @@
+import json
+import re
+import threading
+
+# Patterns used to salvage responses that didn't come back as JSON
+_BRACKETED_LIST_PATTERN = re.compile(r"\[([^\[\]]+)\]")
+_SOUND_ALIKE_PATTERN = re.compile(r"(?:\w+, )+\w+")
+_QUOTED_ITEM_PATTERN = re.compile(r'"([^"\\]*)"')
+_LIST_ITEM_PATTERN = re.compile(r"^\s*(?:\d+[.)]|[-*•])\s*(.+)$", re.MULTILINE)
+_WORD_PATTERN = re.compile(r"^[\w][\w' -]*$")
+_SETUP_PATTERN = re.compile(r"setup\s*:\s*(.+?)\s*punchline\s*:", re.IGNORECASE | re.DOTALL)
+_PUNCHLINE_PATTERN = re.compile(r"punchline\s*:\s*(.+)", re.IGNORECASE)
+_LABEL_PATTERN = re.compile(r"\b(?:setup|punchline)\s*:", re.IGNORECASE)
+
+# How a response was understood
+STRUCTURED = "structured"
+SALVAGED = "salvaged"
+FAILED = "failed"
+
+class ParseStats:
+    """
+    Counts how often each prompt's responses were structured, salvaged, or
+    could not be parsed at all. Used to spot prompts that need rewording.
+    """
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, prompt, outcome):
+        with self._lock:
+            counts = self._counts.setdefault(prompt, {STRUCTURED: 0, SALVAGED: 0, FAILED: 0})
+            counts[outcome] += 1
+
+    def rates(self):
+        """
+        Returns a dict from prompt name to the number of calls, and the
+        fraction of those calls that were structured, salvaged, or failed.
+        """
+        with self._lock:
+            snapshot = {prompt: dict(counts) for (prompt, counts) in self._counts.items()}
+
+        rates = {}
+        for (prompt, counts) in snapshot.items():
+            calls = sum(counts.values())
+            rates[prompt] = {"calls": calls}
+            rates[prompt].update({outcome: count / calls for (outcome, count) in counts.items()})
+        return rates
+
+def parse_word_list(content):
+    """
+    Reads a list of words from a model response. The response should be JSON
+    like {"words": [...]}, but bare JSON lists, truncated JSON, bracketed
+    lists, comma separated lists and numbered or bulleted lists are salvaged.
+
+    Returns a tuple of the words and how they were parsed. The words are None
+    if nothing usable was found, and empty if the model had no suggestions.
+    """
+    decoded = _load_json(content)
+    if isinstance(decoded, dict):
+        decoded = decoded.get("words")
+    if isinstance(decoded, list):
+        # An empty list is a valid answer, the model couldn't think of anything
+        return (_clean_words(item for item in decoded if isinstance(item, str)), STRUCTURED)
+
+    # Function call arguments are often cut off before the array is closed.
+    # Keep the items that were completed.
+    array_start = content.find("[")
+    if array_start >= 0 and "]" not in content[array_start:]:
+        words = _clean_words(_QUOTED_ITEM_PATTERN.findall(content[array_start + 1:]))
+        if words:
+            return (words, SALVAGED)
+
+    for pattern in (_BRACKETED_LIST_PATTERN, _SOUND_ALIKE_PATTERN):
+        matches = pattern.findall(content)
+        if len(matches) == 1:
+            words = _clean_words(matches[0].split(","))
+            if words:
+                return (words, SALVAGED)
+
+    words = _clean_words(_LIST_ITEM_PATTERN.findall(content))
+    if words:
+        return (words, SALVAGED)
+
+    return (None, FAILED)
+
+def parse_joke(content):
+    """
+    Reads a setup and punchline from a model response. The response should be
+    JSON like {"setup": ..., "punchline": ...}, but SETUP:/PUNCHLINE: labels
+    (in any case), a setup and punchline where only one is labelled, and an
+    unlabelled question followed by an answer are salvaged.
+
+    Returns a tuple of the setup, punchline and how they were parsed. The
+    setup and punchline are None if nothing usable was found.
+    """
+    decoded = _load_json(content)
+    if isinstance(decoded, dict):
+        setup = decoded.get("setup")
+        punchline = decoded.get("punchline")
+        if isinstance(setup, str) and isinstance(punchline, str) \
+                and setup.strip() and punchline.strip():
+            return (setup.strip(), punchline.strip(), STRUCTURED)
+
+    setup_matches = _SETUP_PATTERN.findall(content)
+    punchline_matches = _PUNCHLINE_PATTERN.findall(content)
+    if len(setup_matches) == 1 and len(punchline_matches) == 1:
+        return (setup_matches[0].strip(), punchline_matches[0].strip(), SALVAGED)
+
+    # Treat any remaining label as a line break, so it never ends up in the
+    # joke and a label between the setup and punchline still splits them.
+    labelled = _LABEL_PATTERN.search(content) is not None
+    lines = [line.strip() for line in _LABEL_PATTERN.sub("\n", content).splitlines()
+             if line.strip()]
+    if len(lines) == 2 and (labelled or lines[0].endswith("?")):
+        return (lines[0], lines[1], SALVAGED)
+
+    return (None, None, FAILED)
+
+def _load_json(content):
+    try:
+        return json.loads(content)
+    except (TypeError, ValueError):
+        return None
+
+def _clean_words(items):
+    """Strips quotes and whitespace, dropping anything that isn't a word."""
+    words = [item.strip().strip("'\"`").strip() for item in items]
+    return [word for word in words if _WORD_PATTERN.match(word)]
@@ -0,0 +1,138 @@
+import numpy as np
+
+# Rough phonetic classes, loosely based on Soundex. Letters in the same class
+# are treated as sounding alike. Unlike Soundex, vowels are kept as they matter
+# a lot for rhymes. Anything else (hyphens, spaces) gets a class of its own.
+_PHONETIC_CLASSES = ["aeiouy", "bfpv", "cgjkqsxz", "dt", "l", "mn", "r", "hw"]
+_PHONETIC_CODES = np.full(256, len(_PHONETIC_CLASSES) + 1, dtype=np.uint8)
+for _code, _letters in enumerate(_PHONETIC_CLASSES, start=1):
+    for _letter in _letters:
+        _PHONETIC_CODES[ord(_letter)] = _code
+
+class ChangeRanker:
+    """
+    Scores candidate changes against a component to predict which will make the
+    best pun, without calling any models.
+
+    All candidates are scored together in one pass. Lower costs are better. A
+    change is penalised for being far from the component in spelling or sound,
+    for being a very different length, and for not being a word we know.
+    Changes identical to the component are never picked, as they aren't puns.
+    """
+
+    def __init__(self, word_exists, char_weight=1.0, phonetic_weight=1.5,
+                 length_weight=0.5, unknown_weight=0.5, temperature=0.3):
+        """
+        Arguments:
+        word_exists     -- Function that checks if a word is in the short word list.
+        char_weight     -- Cost per character edit, relative to component length.
+        phonetic_weight -- Cost per phonetic edit, relative to component length.
+        length_weight   -- Cost for the change being a different length.
+        unknown_weight  -- Cost for the change not being a known short word.
+        temperature     -- How adventurous sampling is. Near 0 always picks the best.
+        """
+        self._word_exists = word_exists
+        self._weights = np.array([char_weight, phonetic_weight,
+                                  length_weight, unknown_weight])
+        self._temperature = temperature
+
+    def costs(self, component, changes):
+        """
+        Returns an array with the cost of replacing the component with each
+        of the changes.
+        """
+        component = component.lower()
+        changes = [change.strip().lower() for change in changes]
+        component_length = max(len(component), 1)
+        change_lengths = np.array([len(change) for change in changes])
+        encoded_component = _encode(component)
+        encoded_changes = _encode_all(changes)
+
+        char_distance = _edit_distances(encoded_component, encoded_changes,
+                                        change_lengths)
+        phonetic_distance = _edit_distances(_PHONETIC_CODES[encoded_component],
+                                            _PHONETIC_CODES[encoded_changes],
+                                            change_lengths)
+        length_ratio = np.abs(np.log(np.maximum(change_lengths, 1) / component_length))
+        unknown = np.fromiter((not self._word_exists(change) for change in changes),
+                              dtype=bool, count=len(changes))
+
+        features = np.stack([char_distance / component_length,
+                             phonetic_distance / component_length,
+                             length_ratio,
+                             unknown])
+        costs = self._weights @ features
+        costs[char_distance == 0] = np.inf
+        return costs
+
+    def rank(self, component, changes):
+        """Returns the usable changes, ordered from best to worst."""
+        if not changes:
+            return []
+        costs = self.costs(component, changes)
+        return [changes[index] for index in np.argsort(costs, kind="stable")
+                if np.isfinite(costs[index])]
+
+    def choose(self, component, changes, rng=np.random):
+        """
+        Picks a change for the component. Better ranked changes are more
+        likely, but we sample so the same component doesn't always produce the
+        same joke.
+
+        Returns None if none of the changes are usable.
+        """
+        return self.choose_with_cost(component, changes, rng)[0]
+
+    def choose_with_cost(self, component, changes, rng=np.random):
+        """
+        As choose, but returns a tuple of the change and its cost, so that
+        changes picked for different components can be compared.
+
+        Returns (None, inf) if none of the changes are usable.
+        """
+        if not changes:
+            return (None, np.inf)
+        costs = self.costs(component, changes)
+        usable = np.isfinite(costs)
+
+        if not usable.any():
+            return (None, np.inf)
+
+        weights = np.zeros(len(changes))
+        weights[usable] = np.exp((costs[usable].min() - costs[usable]) / self._temperature)
+        index = rng.choice(len(changes), p=weights / weights.sum())
+        return (changes[index], costs[index])
+
+def _encode(word):
+    return np.frombuffer(word.encode("ascii", "replace"), dtype=np.uint8)
+
+def _encode_all(words):
+    """Packs the words into a zero padded (words x max length) array."""
+    width = max((len(word) for word in words), default=0)
+    encoded = np.zeros((len(words), width), dtype=np.uint8)
+    for (row, word) in enumerate(words):
+        encoded[row, :len(word)] = _encode(word)
+    return encoded
+
+def _edit_distances(source, targets, lengths):
+    """
+    Levenshtein distance from the source to each padded target row, where
+    lengths holds the unpadded length of each row.
+
+    Works down the source a character at a time, updating the DP row for every
+    target at once. Insertions along a row are resolved with a running minimum
+    rather than a loop, so the cost is one NumPy pass per source character.
+    """
+    (count, width) = targets.shape
+    positions = np.arange(width + 1)
+    previous = np.broadcast_to(positions, (count, width + 1))
+
+    for (i, char) in enumerate(source, start=1):
+        current = np.empty_like(previous)
+        current[:, 0] = i
+        current[:, 1:] = np.minimum(previous[:, :-1] + (targets != char),
+                                    previous[:, 1:] + 1)
+        current = np.minimum.accumulate(current - positions, axis=1) + positions
+        previous = current
+
+    return previous[np.arange(count), lengths]
@@ -1,14 +1,29 @@
+import atexit
 import logging
 import math
+import os
 import random
+from concurrent.futures import ThreadPoolExecutor
 
 import config as config
+from cache import NegativeCache
 from dictionary import Dictionary
 from models import Models
+from ranking import ChangeRanker
 from errors import * 
 
 #TODO - Move to a general settings config and update the message that goes to the user.
 MAX_TOPIC_LENGTH = 16
+# How long (in seconds) a word that failed to produce a joke is skipped for,
+# once it has failed DEAD_END_THRESHOLD times within that window.
+DEAD_END_TTL = 6 * 60 * 60
+DEAD_END_THRESHOLD = 3
+# Where failure counts are kept between runs, for pruning the word lists.
+DEAD_END_PATH = 'res/dead_ends'
+# How many model lookups a single nucleus attempt may have in flight at once.
+# Each attempt gets its own pool, so concurrent requests don't queue behind
+# each other. Kept small to avoid bursts that trip OpenAI's rate limits.
+MAX_LOOKUP_WORKERS = 4
 
 class Joke:
     """
@@ -58,6 +73,13 @@ class Services:
     def __init__(self):
         self._models = Models()
         self._dictionary = Dictionary()
+        self._dead_ends = NegativeCache(ttl=DEAD_END_TTL, threshold=DEAD_END_THRESHOLD)
+        # Counts as of the last load or save, so that saving only adds what
+        # this process has seen since.
+        self._saved_dead_ends = {}
+        self._load_dead_ends()
+        atexit.register(self.save_dead_ends)
+        self._ranker = ChangeRanker(word_exists=self._dictionary.word_exists)
 
     def tell_joke(self):
         """
@@ -82,13 +104,17 @@ class Services:
         The word 'mat' sounds like 'cat' and is used as the CHANGE.
         It is substituted into 'category' to get 'mat-egory', the SUBSTITUTION.
 
-        This method will try random long words as the nucleus.
+        This method will try random long words as the nucleus. Words that
+        keep failing to produce a joke are skipped.
 
         Returns a Joke object.
         """
         
         logging.info("Generating a joke from scratch")
-        options = self._dictionary.get_random_phrases(10)
+        # Draw extra phrases so that skipping dead ends rarely leaves us short.
+        # The draw can repeat phrases, so remove duplicates.
+        options = [phrase for phrase in dict.fromkeys(self._dictionary.get_random_phrases(20))
+                   if not self._dead_ends.is_known_failure("phrase", phrase)][:10]
 
         logging.debug(f"Possible nucleii: {options}")
 
@@ -99,7 +125,7 @@ class Services:
                 # We'll try again so long as there's another possible option. 
                 # Other exceptions are raised as normal.
                 logging.info(f"Could not think of a joke for {candidate_nucleus}")
-                pass
+                self._dead_ends.record_failure("phrase", candidate_nucleus)
 
         raise NoJokeFoundError()
 
@@ -139,6 +165,8 @@ class Services:
         very different to the input topic. We also won't recursively look for
         related words.
 
+        Strategies that keep failing for the same word are skipped.
+
         Note that this will avoid telling jokes about certain topics such as
         racist slurs. 
 
@@ -174,6 +202,10 @@ class Services:
             joke_types.append("topic")
 
         for joke_type in joke_types:
+            if self._dead_ends.is_known_failure(joke_type, topic):
+                logging.debug(f"Skipping {topic} as a {joke_type}, it keeps failing")
+                continue
+
             try:                                
                 match joke_type:
                     case "phrase":
@@ -187,9 +219,75 @@ class Services:
                     
             except (ModelResponseFormatError, NoJokeFoundError):
                 logging.info(f"Could not think of a joke for {topic} as a {joke_type}")
-                pass
+                self._dead_ends.record_failure(joke_type, topic)
 
         raise NoJokeFoundError()
+
+    def get_dead_ends(self):
+        """
+        Lists the words that have failed to produce jokes, along with the 
+        strategy that was tried and how often it failed. Most frequent first.
+        Useful for pruning the word lists.
+        """
+        return self._dead_ends.entries()
+
+    def save_dead_ends(self):
+        """
+        Adds the failure counts seen since the last save to DEAD_END_PATH, one 
+        tab separated kind, word and count per line, so the word lists can be
+        pruned offline. Called automatically on shutdown.
+
+        The file is re-read and merged before writing, so several worker
+        processes can share it. Writes aren't locked though, so two processes
+        saving at the same moment may still lose one set of counts.
+        """
+        counts = self._read_dead_ends()
+        current = {(entry['kind'], entry['word']): entry['count'] 
+                   for entry in self.get_dead_ends()}
+
+        for (key, count) in current.items():
+            new_failures = count - self._saved_dead_ends.get(key, 0)
+            if new_failures > 0:
+                counts[key] = counts.get(key, 0) + new_failures
+
+        ordered = sorted(counts.items(), key=lambda item: item[1], reverse=True)
+        temporary_path = f"{DEAD_END_PATH}.{os.getpid()}"
+        with open(temporary_path, 'w') as file:
+            file.write('\n'.join(f"{kind}\t{word}\t{count}" 
+                                  for ((kind, word), count) in ordered))
+        os.replace(temporary_path, DEAD_END_PATH)
+
+        self._saved_dead_ends = current
+        logging.info(f"Saved {len(counts)} dead ends to {DEAD_END_PATH}")
+
+    def _load_dead_ends(self):
+        """Carries over failure counts saved by a previous run."""
+        counts = self._read_dead_ends()
+        for ((kind, word), count) in counts.items():
+            self._dead_ends.add_counts(kind, word, count)
+        self._saved_dead_ends = counts
+
+    def _read_dead_ends(self):
+        """
+        Reads the saved failure counts into a dict keyed by kind and word. The
+        file may have been edited by hand, so bad lines are skipped.
+        """
+        counts = {}
+        if not os.path.exists(DEAD_END_PATH):
+            return counts
+
+        for line in config.load_words(DEAD_END_PATH):
+            if not line:
+                continue
+
+            fields = line.split('\t')
+            if len(fields) != 3 or not fields[2].isdigit():
+                logging.warning(f"Skipping malformed line in {DEAD_END_PATH}: [{line}]")
+                continue
+
+            (kind, word, count) = fields
+            counts[(kind, word)] = counts.get((kind, word), 0) + int(count)
+        return counts
     
     def _tell_joke_about_change(self, change):
         logging.info(f"Trying to create a joke for change [{change}]")
@@ -201,27 +299,38 @@ class Services:
             raise NoJokeFoundError()
         
         logging.debug(f"Possible components for [{change}]: [{candidate_components}]")
-        for candidate_component in candidate_components:
-            logging.debug(f"Trying to create a joke where [{candidate_component}] becomes [{change}]")
 
+        # The dictionary is in memory, so probe it for every component up 
+        # front and then pick the component that sounds most like the change.
+        nucleii_by_component = {}
+        for candidate_component in candidate_components:
             candidate_nucleii = self._dictionary.some_phrases_starting_with(candidate_component)
-            
+
             if not candidate_nucleii:
                 logging.debug(f"No nucleii found starting with [{candidate_component}] for [{change}]")
             else:
-                random.shuffle(candidate_nucleii)
-                nucleus = candidate_nucleii[0]
-                logging.debug(f"Trying to joke about [{change}] where it is subbed into [{nucleus}]")
-            
-                substitution = self._get_substitution(nucleus=nucleus, 
-                                                      component=candidate_component, 
-                                                      change=change)
-                
-                return self._put_joke_together(nucleus=nucleus, 
-                                               component=candidate_component,
-                                               change=change,
-                                               substitution=substitution)
-        raise NoJokeFoundError()
+                nucleii_by_component[candidate_component] = candidate_nucleii
+
+        ranked_components = self._ranker.rank(change, list(nucleii_by_component))
+
+        if not ranked_components:
+            logging.info(f"No usable components found for [{change}]")
+            raise NoJokeFoundError()
+
+        component = ranked_components[0]
+        logging.debug(f"Trying to create a joke where [{component}] becomes [{change}]")
+
+        nucleus = random.choice(nucleii_by_component[component])
+        logging.debug(f"Trying to joke about [{change}] where it is subbed into [{nucleus}]")
+    
+        substitution = self._get_substitution(nucleus=nucleus, 
+                                              component=component, 
+                                              change=change)
+        
+        return self._put_joke_together(nucleus=nucleus, 
+                                       component=component,
+                                       change=change,
+                                       substitution=substitution)
     
     def _tell_joke_about_component(self, component):
         """
@@ -242,14 +351,13 @@ class Services:
             logging.debug(f"Trying to joke about the [{component}] in [{nucleus}]")
 
             candidate_changes = self._models.get_words_that_sound_like(word=component)
+            change = self._ranker.choose(component, candidate_changes)
 
-            if not candidate_changes:
+            if not change:
                 logging.info(f"The component [{component}] does not sound like anything")
                 raise NoJokeFoundError()
             else:
                 logging.debug(f"Possible changes for [{component}]: [{candidate_changes}]")
-                random.shuffle(candidate_changes)
-                change = candidate_changes[0]
                 logging.debug(f"Trying to create a joke where [{component}] becomes [{change}]")
 
                 substitution = self._get_substitution(nucleus=nucleus, 
@@ -265,6 +373,11 @@ class Services:
         """
         Attempt to tell a joke using the supplied nucleus. The nucleus will 
         be turned into a pun and used as a punchline.        
+
+        Changes are looked up for all components concurrently, at most 
+        MAX_LOOKUP_WORKERS at a time. Of the components that found a change,
+        the one with the best ranked change is used, favouring longer 
+        components on a tie.
         """
 
         logging.info(f"Trying to create a joke about the nucleus [{nucleus}]")
@@ -277,32 +390,50 @@ class Services:
         
         logging.debug(f"Possible components for [{nucleus}]: [{candidate_components}]")
 
-        for candidate_component in candidate_components:
-            logging.debug(f"Trying to create a joke about the [{candidate_component}] in [{nucleus}]")
+        lookup_pool = ThreadPoolExecutor(max_workers=MAX_LOOKUP_WORKERS,
+                                         thread_name_prefix="lookup")
+        try:
+            lookups = {candidate_component: lookup_pool.submit(
+                            self._models.get_words_that_sound_like_component,
+                            component=candidate_component,
+                            context=nucleus)
+                       for candidate_component in candidate_components}
+
+            options = []
+            for (candidate_component, lookup) in lookups.items():
+                try:
+                    possible_changes = lookup.result()
+                except ModelResponseFormatError:
+                    # Other components may still have usable changes.
+                    logging.info(f"Could not read replacements for the [{candidate_component}] in [{nucleus}]")
+                    continue
+
+                (change, cost) = self._ranker.choose_with_cost(candidate_component, possible_changes)
+
+                if not change:
+                    logging.info(f"No replacements found for the [{candidate_component}] in [{nucleus}]")
+                else:
+                    options.append((cost, -len(candidate_component), candidate_component, change))
+        finally:
+            # If a lookup raised an OpenAI error, don't pay for the ones that 
+            # haven't started yet.
+            lookup_pool.shutdown(wait=False, cancel_futures=True)
+
+        if not options:
+            logging.info(f"No substitutions found for any components of [{nucleus}]")
+            raise NoJokeFoundError()
 
-            possible_changes = self._models.get_words_that_sound_like_component(
-                component=candidate_component,
-                context=nucleus
-            )
+        (_, _, component, change) = min(options)
+        logging.debug(f"Trying to replace the [{component}] in [{nucleus}] with [{change}]")
 
-            if not possible_changes:
-                logging.info(f"No replacements found for the [{candidate_component}] in [{nucleus}]")
-            else:
-                random.shuffle(possible_changes)
-                change = possible_changes[0]
-                logging.debug(f"Trying to replace the [{candidate_component}] in [{nucleus}] with [{change}]")
-
-                substitution = self._get_substitution(nucleus=nucleus, 
-                                component=candidate_component, 
-                                change=change)
+        substitution = self._get_substitution(nucleus=nucleus, 
+                        component=component, 
+                        change=change)
 
-                return self._put_joke_together(nucleus=nucleus, 
-                                               component=candidate_component, 
-                                               change=change,
-                                               substitution=substitution)
-    
-        logging.info(f"No substitutions found for any components of [{nucleus}]")
-        raise NoJokeFoundError()
+        return self._put_joke_together(nucleus=nucleus, 
+                                       component=component, 
+                                       change=change,
+                                       substitution=substitution)
 
     def _tell_joke_about_topic(self, topic):
         """